@@ -3,6 +3,7 @@ from typing import List
 from pydantic_settings import BaseSettings
 from pydantic import AnyHttpUrl
 
+# Serve with: uvicorn app.main:app --loop uvloop --http httptools --workers N
 class Settings(BaseSettings):
     APP_NAME: str = "Whisper STT Service"
     APP_VERSION: str = "1.0.0"
@@ -10,7 +11,17 @@ class Settings(BaseSettings):
 
     # Faster-Whisper
     WHISPER_MODEL: str = "base.en"
-    COMPUTE_TYPE: str = "int8"
+    WHISPER_DEVICE: str = "auto"       # auto | cpu | cuda
+    COMPUTE_TYPE: str = "auto"         # auto -> int8_float16 on CUDA, int8 on CPU
+    TRANSCRIBE_WORKERS: int = 2        # concurrent transcriptions per process
+    BEAM_SIZE_DEFAULT: int = 1         # language given -> greedy decoding
+    BEAM_SIZE_AUTO_LANG: int = 5       # language auto-detected -> beam search
+
+    # ffmpeg (fallback decoder): True runs `ffmpeg -version` instead of a PATH lookup
+    STRICT_FFMPEG_CHECK: bool = False
+
+    # Uploads up to UPLOAD_SPOOL_MB stay in memory; larger ones spill to $TMPDIR
+    UPLOAD_SPOOL_MB: int = 4
 
     # Server
     MAX_UPLOAD_MB: int = 25
@@ -19,6 +30,9 @@ class Settings(BaseSettings):
     CORS_ALLOW_METHODS: List[str] = ["POST", "GET", "OPTIONS"]
     CORS_ALLOW_HEADERS: List[str] = ["*"]
 
+    # Metrics: stt_request_duration_seconds buckets (+Inf is added automatically)
+    HIST_BUCKETS: List[float] = [0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30]
+
     # Rate limiting
     RATELIMIT_RPM: int = 60
 
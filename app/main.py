@@ -1,20 +1,24 @@
 import os
+import sys
+import threading
 import time
 import logging
 import asyncio
-import json
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.websockets import WebSocketState
 
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.formparsers import MultiPartParser
 from starlette.status import HTTP_413_REQUEST_ENTITY_TOO_LARGE
+from starlette.types import ASGIApp, Receive, Scope, Send
 
+import ctranslate2
+import orjson
 from faster_whisper import WhisperModel
 from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from slowapi import Limiter
@@ -25,31 +29,51 @@ from app.core.config import settings
 from app.core.logging import setup_logging
 from app.utils.audio import (
     ensure_ffmpeg_available,
-    save_upload_to_temp,
-    convert_to_wav_16k_mono,
-    cleanup_paths,
+    decode_to_mono16k_ndarray,
+    transcode_stream,
     SUPPORTED_RAW_TYPES,       # still used for reference/logging
     content_type_ok,           # <-- tolerant MIME check
     normalize_content_type,    # <-- for logging
 )
 
+# uvloop when available (uvicorn[standard] ships it); launchers should still pass --loop uvloop
+if sys.platform != "win32":
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
 # ---------------------------
 # Logging & metrics
 # ---------------------------
 setup_logging()
 logger = logging.getLogger("stt-service")
 
-REQUEST_TIME = Histogram("stt_request_duration_seconds", "Transcription request duration (s)")
+# Explicit STT-sized buckets (sub-second .. 30s) instead of the 14 client defaults;
+# kept label-free so this stays one small series set per pod.
+REQUEST_TIME = Histogram(
+    "stt_request_duration_seconds",
+    "Transcription request duration (s)",
+    buckets=settings.HIST_BUCKETS,
+)
 REQUEST_COUNTER = Counter("stt_requests_total", "Total transcription requests", ["transport"])
+# bound children, so the hot paths skip the labels() lookup + lock
+REQ_HTTP = REQUEST_COUNTER.labels(transport="http")
+REQ_WS = REQUEST_COUNTER.labels(transport="ws")
 ERROR_COUNTER = Counter("stt_errors_total", "Total errors")
 
 # Rate limiting
-limiter = Limiter(key_func=get_remote_address, default_limits=[f"{settings.RATELIMIT_RPM}/minute"])
+RATE_LIMIT = f"{settings.RATELIMIT_RPM}/minute"
+limiter = Limiter(key_func=get_remote_address, default_limits=[RATE_LIMIT])
 
 # ---------------------------
 # App init
 # ---------------------------
-app = FastAPI(title=settings.APP_NAME, version=settings.APP_VERSION)
+# Keep typical uploads in RAM: Starlette only spills multipart files to disk above this
+MultiPartParser.max_file_size = settings.UPLOAD_SPOOL_MB * 1024 * 1024
+
+app = FastAPI(title=settings.APP_NAME, version=settings.APP_VERSION, default_response_class=ORJSONResponse)
 
 # CORS (tighten for prod)
 app.add_middleware(
@@ -60,20 +84,27 @@ app.add_middleware(
     allow_headers=settings.CORS_ALLOW_HEADERS,
 )
 
-# Size limit middleware
-class BodySizeLimitMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, max_body_size_mb: int):
-        super().__init__(app)
+# Size limit middleware (plain ASGI: it only reads one header, so skip BaseHTTPMiddleware's task group)
+class BodySizeLimitMiddleware:
+    def __init__(self, app: ASGIApp, max_body_size_mb: int):
+        self.app = app
         self.max = max_body_size_mb * 1024 * 1024
-
-    async def dispatch(self, request: Request, call_next):
-        cl = request.headers.get("content-length")
-        if cl and cl.isdigit() and int(cl) > self.max:
-            return JSONResponse(
-                {"detail": f"Request too large. Max {settings.MAX_UPLOAD_MB} MB"},
-                status_code=HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-            )
-        return await call_next(request)
+        self._body = orjson.dumps({"detail": f"Request too large. Max {max_body_size_mb} MB"})
+        self._headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(self._body)).encode()),
+        ]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            for k, v in scope["headers"]:
+                if k == b"content-length":
+                    if v.isdigit() and int(v) > self.max:
+                        await send({"type": "http.response.start", "status": HTTP_413_REQUEST_ENTITY_TOO_LARGE, "headers": self._headers})
+                        await send({"type": "http.response.body", "body": self._body})
+                        return
+                    break
+        await self.app(scope, receive, send)
 
 app.add_middleware(BodySizeLimitMiddleware, max_body_size_mb=settings.MAX_UPLOAD_MB)
 
@@ -88,18 +119,81 @@ def rate_limit_handler(request: Request, exc: RateLimitExceeded):
 # Whisper model singleton
 MODEL: Optional[WhisperModel] = None
 
+# Transcription is a long synchronous CTranslate2 call; run it here, not on the event loop
+TRANSCRIBE_POOL = ThreadPoolExecutor(max_workers=settings.TRANSCRIBE_WORKERS, thread_name_prefix="transcribe")
+
+def transcribe_blocking(audio, **kwargs):
+    segments, info = MODEL.transcribe(audio, **kwargs)
+    # segments is lazy and decoding happens while iterating, so drain it in the worker too
+    return list(segments), info
+
+def transcribe_kwargs(language: Optional[str], initial_prompt: Optional[str]) -> dict:
+    # English-only models (*.en) have nothing to detect, so the language is fixed either way
+    auto_lang = language is None and MODEL is not None and MODEL.model.is_multilingual
+    return dict(
+        language=language,                 # None -> auto
+        vad_filter=True,
+        # greedy when the language is pinned; widen the beam only for auto-detect
+        beam_size=settings.BEAM_SIZE_AUTO_LANG if auto_lang else settings.BEAM_SIZE_DEFAULT,
+        best_of=1,
+        temperature=[0.0],
+        condition_on_previous_text=False,
+        initial_prompt=initial_prompt,
+    )
+
+# end-of-stream marker for stream_segments_blocking
+SEGMENTS_DONE = object()
+
+def stream_segments_blocking(loop: asyncio.AbstractEventLoop, queue: asyncio.Queue,
+                             cancelled: threading.Event, audio, **kwargs):
+    """
+    Run in TRANSCRIBE_POOL: hand each segment to the loop as soon as the decoder yields it.
+    Stops early once `cancelled` is set (client gone), freeing the worker.
+    """
+    try:
+        segments, info = MODEL.transcribe(audio, **kwargs)
+        for seg in segments:
+            if cancelled.is_set():
+                break
+            t = seg.text.strip()
+            if t:
+                loop.call_soon_threadsafe(queue.put_nowait, {"start": seg.start, "end": seg.end, "text": t})
+        return info
+    finally:
+        loop.call_soon_threadsafe(queue.put_nowait, SEGMENTS_DONE)
+
+def pick_compute_type() -> str:
+    """Resolve COMPUTE_TYPE=auto: int8_float16 on CUDA; CTranslate2 has no CPU bf16 path, so CPU gets int8."""
+    if settings.COMPUTE_TYPE != "auto":
+        return settings.COMPUTE_TYPE
+    device = settings.WHISPER_DEVICE
+    if device == "cuda" or (device == "auto" and ctranslate2.get_cuda_device_count() > 0):
+        return "int8_float16"
+    return "int8"
+
 @app.on_event("startup")
 def startup_event():
     global MODEL
-    ensure_ffmpeg_available()
-    logger.info("Loading Whisper model '%s' with compute_type=%s", settings.WHISPER_MODEL, settings.COMPUTE_TYPE)
+    ensure_ffmpeg_available(strict=settings.STRICT_FFMPEG_CHECK)
+    logger.info("Event loop: %s", type(asyncio.get_running_loop()).__module__)
+    compute_type = pick_compute_type()
+    logger.info("Loading Whisper model '%s' on device=%s with compute_type=%s",
+                settings.WHISPER_MODEL, settings.WHISPER_DEVICE, compute_type)
     t0 = time.time()
-    MODEL = WhisperModel(settings.WHISPER_MODEL, compute_type=settings.COMPUTE_TYPE)
+    MODEL = WhisperModel(
+        settings.WHISPER_MODEL,
+        device=settings.WHISPER_DEVICE,
+        compute_type=compute_type,
+        # cpu_threads is per worker; split the cores instead of oversubscribing them
+        cpu_threads=max(1, (os.cpu_count() or 1) // settings.TRANSCRIBE_WORKERS),
+        num_workers=settings.TRANSCRIBE_WORKERS,
+    )
     logger.info("Model loaded in %.2fs", time.time() - t0)
 
 @app.on_event("shutdown")
 def shutdown_event():
     logger.info("Shutting down…")
+    TRANSCRIBE_POOL.shutdown(wait=False, cancel_futures=True)
 
 # ---------------------------
 # Health & metrics
@@ -129,7 +223,7 @@ async def unhandled_exc(request: Request, exc: Exception):
 # Transcription endpoint (HTTP)
 # ---------------------------
 @app.post("/webhook/audio", tags=["stt"])
-@limiter.limit(f"{settings.RATELIMIT_RPM}/minute")
+@limiter.limit(RATE_LIMIT)
 async def transcribe_audio(
     request: Request,
     file: UploadFile = File(...),
@@ -137,10 +231,11 @@ async def transcribe_audio(
     initial_prompt: Optional[str] = None,
 ):
     """
-    Accepts browser audio (webm/ogg/wav/mp3/etc), converts to 16k mono WAV, then transcribes.
+    Accepts browser audio (webm/ogg/wav/mp3/etc), decodes in-process to 16k mono PCM, then transcribes.
+    Falls back to ffmpeg for codecs the bundled libav can't handle.
     Returns transcript + segment timestamps.
     """
-    REQUEST_COUNTER.labels(transport="http").inc()
+    REQ_HTTP.inc()
     t0 = time.perf_counter()
 
     # Be lenient: many browsers send 'audio/webm;codecs=opus'
@@ -150,31 +245,26 @@ async def transcribe_audio(
     if MODEL is None:
         raise HTTPException(status_code=503, detail="Model not ready")
 
-    # Persist uploaded file to temp
-    base_suffix = ""
-    if file.filename and "." in file.filename:
-        base_suffix = "." + file.filename.split(".")[-1]
-    in_path = out_wav = None
-
     try:
-        in_path = save_upload_to_temp(file, suffix=base_suffix)
-
-        # Convert everything to 16k mono pcm wav
+        # Decode straight from the upload spool into a 16k mono float32 array
+        # (off the event loop; libav decode is synchronous)
         try:
-            out_wav, _ = convert_to_wav_16k_mono(in_path)
-        except RuntimeError as conv_err:
-            ct = normalize_content_type(file.content_type)
-            logger.warning("Conversion failed for content-type '%s': %s", ct, conv_err)
-            raise HTTPException(status_code=415, detail="Unsupported or invalid audio format") from conv_err
+            audio = await asyncio.to_thread(decode_to_mono16k_ndarray, file.file)
+        except RuntimeError as dec_err:
+            logger.info("In-process decode failed (%s); falling back to ffmpeg", dec_err)
+            await file.seek(0)
+            try:
+                audio = await transcode_stream(file)
+            except RuntimeError as conv_err:
+                ct = normalize_content_type(file.content_type)
+                logger.warning("Conversion failed for content-type '%s': %s", ct, conv_err)
+                raise HTTPException(status_code=415, detail="Unsupported or invalid audio format") from conv_err
 
         # Transcribe
-        segments, info = MODEL.transcribe(
-            out_wav,
-            language=language,                 # None -> auto
-            vad_filter=True,
-            beam_size=5,
-            condition_on_previous_text=False,
-            initial_prompt=initial_prompt,
+        loop = asyncio.get_running_loop()
+        segments, info = await loop.run_in_executor(
+            TRANSCRIBE_POOL,
+            lambda: transcribe_blocking(audio, **transcribe_kwargs(language, initial_prompt)),
         )
 
         parts = []
@@ -205,44 +295,35 @@ async def transcribe_audio(
         raise HTTPException(status_code=400, detail=f"Transcription failed: {e}")
     finally:
         REQUEST_TIME.observe(time.perf_counter() - t0)
-        cleanup_paths(in_path, out_wav)
 
 # ---------------------------
 # WebSocket streaming endpoint
 # ---------------------------
+_ACK_OK = orjson.dumps({"ok": True, "msg": "config updated"})
+_ACK_BAD = orjson.dumps({"ok": False, "error": "invalid text frame"})
+
 @app.websocket("/ws/transcribe")
 async def ws_transcribe(websocket: WebSocket):
     """
     WebSocket that accepts binary audio chunks (webm/ogg/m4a/mp3/etc).
     Optionally send a small JSON text frame first:
       {"language": "en", "initial_prompt": "context..."}
-    Then send binary audio frames; the server responds with JSON transcripts.
+    Then send binary audio frames; for each one the server streams
+      {"ok": true, "segments": [...]} frames as they decode, then
+      {"ok": true, "done": true, "transcript": ..., ...}.
     """
     await websocket.accept()
     language: Optional[str] = None
     initial_prompt: Optional[str] = None
 
-    # Try to read an optional initial JSON config quickly
-    try:
-        msg = await asyncio.wait_for(websocket.receive_text(), timeout=0.05)
-        try:
-            cfg = json.loads(msg)
-            language = cfg.get("language")
-            initial_prompt = cfg.get("initial_prompt")
-        except Exception:
-            pass
-    except asyncio.TimeoutError:
-        pass
-    except WebSocketDisconnect:
-        return
-    except Exception:
-        pass
-
     if MODEL is None:
-        await websocket.send_text(json.dumps({"ok": False, "error": "Model not ready"}))
+        await websocket.send_bytes(orjson.dumps({"ok": False, "error": "Model not ready"}))
         await websocket.close(code=1013)
         return
 
+    # rebuilt only when a config frame changes language/prompt
+    tkw = transcribe_kwargs(language, initial_prompt)
+
     try:
         while True:
             msg = await websocket.receive()
@@ -251,64 +332,81 @@ async def ws_transcribe(websocket: WebSocket):
 
             # Binary frames = audio chunks
             if "bytes" in msg and msg["bytes"] is not None:
-                REQUEST_COUNTER.labels(transport="ws").inc()
+                REQ_WS.inc()
                 raw = msg["bytes"]
-                in_path = out_wav = None
                 t0 = time.perf_counter()
                 try:
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as tmp:
-                        tmp.write(raw)
-                        in_path = tmp.name
-
-                    out_wav, _ = convert_to_wav_16k_mono(in_path)
-
-                    segments, info = MODEL.transcribe(
-                        out_wav,
-                        language=language,
-                        vad_filter=True,
-                        beam_size=5,
-                        condition_on_previous_text=False,
-                        initial_prompt=initial_prompt,
+                    try:
+                        audio = await asyncio.to_thread(decode_to_mono16k_ndarray, raw)
+                    except RuntimeError:
+                        # exotic codec: let the system ffmpeg have a go
+                        audio = await transcode_stream(raw)
+
+                    loop = asyncio.get_running_loop()
+                    queue: asyncio.Queue = asyncio.Queue()
+                    cancelled = threading.Event()
+                    producer = loop.run_in_executor(
+                        TRANSCRIBE_POOL,
+                        lambda: stream_segments_blocking(loop, queue, cancelled, audio, **tkw),
                     )
 
-                    parts, segs_out = [], []
-                    for seg in segments:
-                        t = seg.text.strip()
-                        if t:
-                            parts.append(t)
-                            segs_out.append({"start": seg.start, "end": seg.end, "text": t})
-
-                    await websocket.send_text(json.dumps({
+                    # Forward segments while the decoder is still working on the rest.
+                    # Whatever piled up during the previous send goes out as one frame,
+                    # so a slow client gets fewer, larger frames instead of a backlog.
+                    try:
+                        parts = []
+                        done = False
+                        while not done:
+                            batch = []
+                            seg = await queue.get()
+                            while True:
+                                if seg is SEGMENTS_DONE:
+                                    done = True
+                                    break
+                                batch.append(seg)
+                                try:
+                                    seg = queue.get_nowait()
+                                except asyncio.QueueEmpty:
+                                    break
+                            if batch:
+                                parts.extend(b["text"] for b in batch)
+                                await websocket.send_bytes(orjson.dumps({"ok": True, "segments": batch}))
+                    finally:
+                        # on a failed send, stop the worker instead of decoding into the void
+                        cancelled.set()
+                    info = await producer
+
+                    await websocket.send_bytes(orjson.dumps({
                         "ok": True,
+                        "done": True,
                         "transcript": " ".join(parts).strip(),
-                        "segments": segs_out,
                         "duration": getattr(info, "duration", None),
                         "language": getattr(info, "language", language),
                     }))
                 except Exception as e:
-                    await websocket.send_text(json.dumps({"ok": False, "error": str(e)}))
+                    await websocket.send_bytes(orjson.dumps({"ok": False, "error": str(e)}))
                 finally:
                     REQUEST_TIME.observe(time.perf_counter() - t0)
-                    cleanup_paths(in_path, out_wav)
 
-            # Optional text frames to update config mid-session
+            # Text frames = config, either up front or mid-session
             elif "text" in msg and msg["text"] is not None:
                 try:
-                    data = json.loads(msg["text"])
+                    data = orjson.loads(msg["text"])
                     if "language" in data:
                         language = data["language"]
                     if "initial_prompt" in data:
                         initial_prompt = data["initial_prompt"]
-                    await websocket.send_text(json.dumps({"ok": True, "msg": "config updated"}))
+                    tkw = transcribe_kwargs(language, initial_prompt)
+                    await websocket.send_bytes(_ACK_OK)
                 except Exception:
-                    await websocket.send_text(json.dumps({"ok": False, "error": "invalid text frame"}))
+                    await websocket.send_bytes(_ACK_BAD)
 
     except WebSocketDisconnect:
         pass
     except Exception as e:
         try:
             if websocket.application_state == WebSocketState.CONNECTED:
-                await websocket.send_text(json.dumps({"ok": False, "error": f"server error: {e}"}))
+                await websocket.send_bytes(orjson.dumps({"ok": False, "error": f"server error: {e}"}))
         finally:
             try:
                 await websocket.close()
@@ -318,8 +416,10 @@ async def ws_transcribe(websocket: WebSocket):
 # ---------------------------
 # Static files (serve /static/recorder.html)
 # ---------------------------
+# resolved once here rather than carrying the ".." into every lookup; check_dir fails fast at import
+_STATIC_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "static"))
 app.mount(
     "/static",
-    StaticFiles(directory=os.path.join(os.path.dirname(__file__), "..", "static")),
+    StaticFiles(directory=_STATIC_DIR, html=False, check_dir=True),
     name="static",
 )
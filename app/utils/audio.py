@@ -1,11 +1,21 @@
 # app/utils/audio.py
-import os
+import asyncio
+import io
+import shutil
 import subprocess
-import tempfile
-from typing import Tuple
+from typing import BinaryIO, Optional, Tuple
+
+import av
+import numpy as np
+
+# Whisper expects 16 kHz mono float32 in [-1, 1]
+SAMPLE_RATE = 16000
+# Upper bound for the up-front decode buffer; the container's duration is client-controlled,
+# so anything longer than this just grows the buffer as real samples arrive
+MAX_PREALLOC_SAMPLES = 10 * 60 * SAMPLE_RATE
 
 # keep the base types; we'll allow any 'audio/*' plus parameters too
-SUPPORTED_RAW_TYPES = {
+SUPPORTED_RAW_TYPES = frozenset({
     "audio/wav",
     "audio/x-wav",
     "audio/webm",
@@ -17,7 +27,7 @@ SUPPORTED_RAW_TYPES = {
     "audio/aac",
     "audio/flac",
     "application/octet-stream",  # some browsers/drivers send this
-}
+})
 
 def normalize_content_type(ct: str | None) -> str:
     if not ct:
@@ -25,43 +35,126 @@ def normalize_content_type(ct: str | None) -> str:
     return ct.split(";", 1)[0].strip().lower()  # drop ;codecs=opus etc.
 
 def content_type_ok(ct: str | None) -> bool:
-    base = normalize_content_type(ct)
-    if not base:
+    if not ct:
         return True
-    # allow any audio/* even if not enumerated above; ffmpeg will be the final arbiter
-    return base in SUPPORTED_RAW_TYPES or base.startswith("audio/")
+    i = ct.find(";")
+    base = (ct[:i] if i >= 0 else ct).strip().lower()
+    # allow any audio/* even if not enumerated above; the decoder will be the final arbiter
+    return not base or base.startswith("audio/") or base in SUPPORTED_RAW_TYPES
 
-def ensure_ffmpeg_available():
+# set once ffmpeg has been found; the real saving is shutil.which instead of spawning `ffmpeg -version`
+_ffmpeg_ok: Optional[bool] = None
+
+def ensure_ffmpeg_available(strict: bool = False):
+    global _ffmpeg_ok
+    if _ffmpeg_ok:
+        return
+    # a PATH lookup is enough unless we've been asked to actually run the binary
+    if shutil.which("ffmpeg") and not strict:
+        _ffmpeg_ok = True
+        return
     try:
         subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
     except Exception as e:
         raise RuntimeError("ffmpeg is required but not found in PATH") from e
+    _ffmpeg_ok = True
+
+def _append_samples(buf: np.ndarray, n: int, samples: np.ndarray) -> Tuple[np.ndarray, int]:
+    end = n + samples.shape[0]
+    if end > buf.shape[0]:
+        grown = np.empty(max(end, buf.shape[0] * 2), dtype=buf.dtype)
+        grown[:n] = buf[:n]
+        buf = grown
+    buf[n:end] = samples
+    return buf, end
+
+def decode_to_mono16k_ndarray(source: str | bytes | BinaryIO) -> np.ndarray:
+    """
+    Decode audio in-process with PyAV (libav) into a 16 kHz mono float32 array,
+    ready to hand to WhisperModel.transcribe. No subprocess, no temp files.
+    Raises RuntimeError if the container/codec can't be decoded.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    try:
+        with av.open(source, mode="r", metadata_errors="ignore") as container:
+            if not container.streams.audio:
+                raise RuntimeError("no audio stream found")
+            stream = container.streams.audio[0]
+            resampler = av.AudioResampler(format="s16", layout="mono", rate=SAMPLE_RATE)
+
+            # size from container duration when known (browser webm chunks often omit it)
+            est = 0
+            if stream.duration and stream.time_base:
+                est = int(stream.duration * stream.time_base * SAMPLE_RATE)
+            buf = np.empty(min(max(est, SAMPLE_RATE), MAX_PREALLOC_SAMPLES), dtype=np.int16)
+            n = 0
+
+            for frame in container.decode(stream):
+                frame.pts = None
+                for out in resampler.resample(frame):
+                    buf, n = _append_samples(buf, n, out.to_ndarray().reshape(-1))
+            for out in resampler.resample(None):  # flush
+                buf, n = _append_samples(buf, n, out.to_ndarray().reshape(-1))
+    except av.error.FFmpegError as e:
+        raise RuntimeError(f"audio decode failed: {e}") from e
 
-def save_upload_to_temp(upload_file, suffix: str = "") -> str:
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        for chunk in iter(lambda: upload_file.file.read(1024 * 1024), b""):
-            tmp.write(chunk)
-        return tmp.name
-
-def convert_to_wav_16k_mono(in_path: str) -> Tuple[str, bool]:
-    out_path = in_path + ".wav"
-    cmd = [
-        "ffmpeg", "-y",
-        "-i", in_path,
-        "-ar", "16000",
-        "-ac", "1",
-        "-c:a", "pcm_s16le",
-        out_path,
-    ]
-    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if res.returncode != 0:
-        raise RuntimeError(f"ffmpeg conversion failed: {res.stderr.decode('utf-8', 'ignore')}")
-    return out_path, True
-
-def cleanup_paths(*paths: str):
-    for p in paths:
-        if p and os.path.exists(p):
+    return buf[:n].astype(np.float32) / 32768.0
+
+# ffmpeg reads the original container from stdin and writes raw 16k mono PCM to stdout
+FFMPEG_PCM_CMD = (
+    "ffmpeg", "-loglevel", "error",
+    "-i", "pipe:0",
+    "-ar", str(SAMPLE_RATE),
+    "-ac", "1",
+    "-f", "s16le",
+    "pipe:1",
+)
+
+async def transcode_stream(source, chunk_size: int = 4 * 1024 * 1024) -> np.ndarray:
+    """
+    Pipe audio (raw bytes, or anything with an async read() like UploadFile)
+    through ffmpeg's stdin and collect 16k mono PCM from stdout, without
+    touching disk. Returns float32 samples like decode_to_mono16k_ndarray.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *FFMPEG_PCM_CMD,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    async def pump_upload_to_stdin():
+        try:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                proc.stdin.write(source)
+                await proc.stdin.drain()
+            else:
+                while chunk := await source.read(chunk_size):
+                    proc.stdin.write(chunk)
+                    await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg gave up early; stderr tells us why
+        finally:
+            proc.stdin.close()
+
+    try:
+        # stdout/stderr must drain concurrently with the write or the pipes deadlock
+        _, out, err = await asyncio.gather(pump_upload_to_stdin(), proc.stdout.read(), proc.stderr.read())
+        await proc.wait()
+    except BaseException:
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            # reap it so cancelled/failed fallbacks don't leave zombie ffmpeg processes
             try:
-                os.remove(p)
-            except Exception:
+                await asyncio.wait_for(asyncio.shield(proc.wait()), timeout=5)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
                 pass
+        raise
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg conversion failed: {err.decode('utf-8', 'ignore')}")
+    return np.frombuffer(out, dtype=np.int16).astype(np.float32) / 32768.0